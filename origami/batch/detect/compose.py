@@ -2,13 +2,16 @@
 
 import click
 import collections
+import itertools
+import re
 import codecs
 import logging
-import io
+import numpy as np
 import shapely
+import shapely.ops
+import shapely.prepared
 
 from pathlib import Path
-from tabulate import tabulate
 from cached_property import cached_property
 
 from origami.batch.core.processor import Processor
@@ -25,7 +28,10 @@ def sorted_by_keys(x):
 def polygon_union(geoms):
 	if not geoms:
 		return None
-	shape = shapely.ops.cascaded_union(geoms)
+	if len(geoms) == 1:
+		shape = geoms[0]
+	else:
+		shape = shapely.ops.unary_union(geoms)
 	if shape.geom_type != "Polygon":
 		shape = shape.convex_hull
 	if shape.is_empty or not shape.is_valid:
@@ -34,43 +40,112 @@ def polygon_union(geoms):
 		return shape
 
 
+def format_psql_table(rows, has_header):
+	# formats rows of (possibly multiline) strings in the layout of
+	# tabulate's "psql" format, with all columns aligned left.
+
+	# like tabulate, drop rows that are entirely empty as soon as
+	# any cell is multiline.
+	if any("\n" in s or "\r" in s for row in rows for s in row):
+		# like tabulate, trim leading and trailing blank lines of
+		# cells, but keep all lines of headers.
+		cells = [[s.strip().splitlines() for s in row] for row in rows]
+		if has_header:
+			cells[0] = [re.split(r"\r|\n|\r\n", s) for s in rows[0]]
+	else:
+		cells = [[[s.strip()] for s in row] for row in rows]
+		if has_header:
+			cells[0] = [[s] for s in rows[0]]
+
+	widths = [0] * len(cells[0])
+	for i, row in enumerate(cells):
+		# like tabulate, keep a minimum padding around headers.
+		padding = 2 if has_header and i == 0 else 0
+		for j, lines in enumerate(row):
+			widths[j] = max(widths[j], padding + max(map(len, lines), default=0))
+
+	def format_row(row):
+		for k in range(max(map(len, row))):
+			yield "| " + " | ".join(
+				(lines[k] if k < len(lines) else "").ljust(width)
+				for lines, width in zip(row, widths)) + " |"
+
+	dashes = ["-" * (width + 2) for width in widths]
+	rule = "+" + "+".join(dashes) + "+"
+
+	formatted = [rule]
+	if has_header:
+		formatted.extend(format_row(cells[0]))
+		formatted.append("|" + "+".join(dashes) + "|")
+		cells = cells[1:]
+	for row in cells:
+		formatted.extend(format_row(row))
+	formatted.append(rule)
+
+	return "\n".join(formatted)
+
+
+def bit_indices(mask):
+	return [i for i in range(mask.bit_length()) if (mask >> i) & 1]
+
+
+def cell_key(division, row, column):
+	# division, row and column are small non-negative ints.
+	return (division << 32) | (row << 16) | column
+
+
 def fix_bogus_tabular_path(path):
-	if path[:2] == ("regions", "TABULAR") and "." not in path[2]:
+	if path[1] == "TABULAR" and path[0] == "regions" and "." not in path[2]:
 		assert len(path) == 3
 		return path[0], path[1], path[2] + ".1.1.1"
 	else:
 		return path
 
 
+class RewarpedCoords:
+	""" collects Page XML coords so that they can be rewarped in one batch. """
+
+	def __init__(self, document):
+		self._document = document
+		self._nodes = []
+		self._rings = []
+
+	def add(self, px_node, coords):
+		self._nodes.append(px_node)
+		self._rings.append(coords)
+
+	def flush(self):
+		warped = self._document.rewarp_many(self._rings)
+		for px_node, coords in zip(self._nodes, warped):
+			px_node.prepend_coords(coords)
+		self._nodes = []
+		self._rings = []
+
+
 class MergedTextRegion:
 	def __init__(self, document, block_path, lines):
 		self._block_path = block_path
 		self._polygon = polygon_union([
 			line.image_space_polygon for _, line in lines])
-		self._document = document
-		self._transform = document.rewarp
-		self._lines = lines
+		self._entries = [
+			(line_path, line, document.get(line_path[:3]).get_line_text(line_path))
+			for line_path, line in lines]
 
-	def export_page_xml(self, px_document, only_regions):
+	def export_page_xml(self, px_document, px_coords, only_regions):
 		if self._polygon is None:
 			return
 
 		px_region = px_document.append_region(
 			"TextRegion", id_="-".join(self._block_path))
-		px_region.append_coords(self._transform(
-			self._polygon.exterior.coords))
+		px_coords.add(px_region, self._polygon.exterior.coords)
 
 		if only_regions:
-			texts = []
-			for i, (line_path, line) in enumerate(self._lines):
-				texts.append(self._document.get(line_path[:3]).get_line_text(line_path))
-			px_region.append_text_equiv("\n".join(texts))
+			px_region.append_text_equiv("\n".join(
+				line_text for _, _, line_text in self._entries))
 		else:
-			for i, (line_path, line) in enumerate(self._lines):
-				line_text = self._document.get(line_path[:3]).get_line_text(line_path)
+			for i, (line_path, line, line_text) in enumerate(self._entries):
 				px_line = px_region.append_text_line(id_="-".join(self._block_path + (str(i),)))
-				px_line.append_coords(self._transform(
-					line.image_space_polygon.exterior.coords))
+				px_coords.add(px_line, line.image_space_polygon.exterior.coords)
 				px_line.append_text_equiv(line_text)
 
 
@@ -87,8 +162,8 @@ class TextRegion:
 		self._lines = lines
 		self._line_texts = dict()
 
-		self._order = []
-		self._transform = document.rewarp
+		# (line path, line, text) in reading order.
+		self._entries = []
 
 	@property
 	def polygon(self):
@@ -98,47 +173,40 @@ class TextRegion:
 		return self._line_texts[line_path]
 
 	def export_plain_text_region(self, composition):
-		for p in self._order:
-			composition.append_text(p, self._line_texts[p])
+		for line_path, _, text in self._entries:
+			composition.append_text(line_path, text)
 
 	def export_plain_text_line(self, composition, line_path):
 		composition.append_text(
 			line_path, self._line_texts[line_path])
 
-	def export_page_xml(self, px_document, only_regions):
+	def export_page_xml(self, px_document, px_coords, only_regions):
 		px_region = px_document.append_region(
 			"TextRegion", id_="-".join(self._block_path))
+		px_coords.add(px_region, self._polygon.exterior.coords)
 
-		px_region.append_coords(self._transform(
-			self._polygon.exterior.coords))
-
-		line_paths = []
-		for line_path in self._order:
-			line = self._lines[line_path]
-
+		entries = []
+		for line_path, line, text in self._entries:
 			if line.image_space_polygon.is_empty:
-				if self._line_texts[line_path]:
+				if text:
 					raise RuntimeError(
 						"line %s has text '%s', confidence %.2f, but empty geometry" % (
-							str(line_path), self._line_texts[line_path], line.confidence))
+							str(line_path), text, line.confidence))
 				continue
 
-			line_paths.append((line_path, line))
+			entries.append((line_path, line, text))
 
 		if only_regions:
-			texts = []
-			for line_path, line in line_paths:
-				texts.append(self._line_texts[line_path])
-			px_region.append_text_equiv("\n".join(texts))
+			px_region.append_text_equiv("\n".join(
+				text for _, _, text in entries))
 		else:
-			for line_path, line in line_paths:
+			for line_path, line, text in entries:
 				px_line = px_region.append_text_line(id_="-".join(line_path))
-				px_line.append_coords(self._transform(
-					line.image_space_polygon.exterior.coords))
-				px_line.append_text_equiv(self._line_texts[line_path])
+				px_coords.add(px_line, line.image_space_polygon.exterior.coords)
+				px_line.append_text_equiv(text)
 
 	def add_text(self, line_path, text):
-		self._order.append(line_path)
+		self._entries.append((line_path, self._lines[line_path], text))
 		self._line_texts[line_path] = text
 
 
@@ -148,11 +216,12 @@ class TableRegion:
 
 		self._lines = lines
 		self._block_path = block_path
-		self._divisions = set()
-		self._rows = collections.defaultdict(set)
-		self._columns = set()
+		# divisions, rows and columns are kept as bit masks
+		# of their indices, texts are keyed by cell_key().
+		self._divisions = 0
+		self._rows = collections.defaultdict(int)
+		self._columns = 0
 		self._texts = collections.defaultdict(list)
-		self._transform = document.rewarp
 		self._document = document
 
 		self._blocks = dict()
@@ -207,15 +276,24 @@ class TableRegion:
 
 		return line_shape
 
-	def export_page_xml(self, px_document, only_regions):
+	def export_page_xml(self, px_document, px_coords, only_regions):
 		table_id = "-".join(self._block_path)
 		px_table_region = px_document.append_region(
 			"TableRegion", id_=table_id)
 
-		columns = sorted(list(self._columns))
-		divisions = sorted(list(self._divisions))
+		columns = bit_indices(self._columns)
+		divisions = bit_indices(self._divisions)
 		column_shapes = []
 
+		# rows do not depend on the column, so list them once
+		# instead of once per column.
+		division_rows = dict(
+			(division, bit_indices(self._rows[division]))
+			for division in divisions)
+
+		texts_by_cell = self._texts
+		get_cell_shape = self._get_cell_shape
+
 		# make sure to look at subdivide_table_blocks
 		# in LAYOUT stage to understand this.
 
@@ -229,16 +307,15 @@ class TableRegion:
 				px_division = px_column.append_text_region(id_=division_id)
 				cell_shapes = []
 
-				rows = sorted(list(self._rows[division]))
-				for row in rows:
+				for row in division_rows[division]:
 					cell_id = "%s.%d" % (division_id, row)
 					px_cell = px_division.append_text_region(id_=cell_id)
 
 					line_shapes = []
-					texts = self._texts.get((division, row, column), [])
+					texts = texts_by_cell.get(cell_key(division, row, column), [])
 					for cell_line_path, text in texts:
 
-						line_shape = self._get_cell_shape(cell_line_path)
+						line_shape = get_cell_shape(cell_line_path)
 						if line_shape.geom_type == "Polygon" and line_shape.area > 1:
 							add_cell = True
 							line_shapes.append(line_shape)
@@ -261,8 +338,7 @@ class TableRegion:
 							px_line = px_cell.append_text_line(
 								id_="-".join(cell_line_path))
 							if line_shape is not None:
-								px_line.append_coords(self._transform(
-									line_shape.exterior.coords))
+								px_coords.add(px_line, line_shape.exterior.coords)
 							px_line.append_text_equiv(text)
 
 					if line_shapes:
@@ -271,32 +347,28 @@ class TableRegion:
 						cell_shape = None
 
 					if cell_shape is not None:
-						px_cell.prepend_coords(self._transform(
-							cell_shape.exterior.coords))
+						px_coords.add(px_cell, cell_shape.exterior.coords)
 						cell_shapes.append(cell_shape)
 					else:
 						px_division.remove(px_cell)
 
 				division_shape = polygon_union(cell_shapes)
 				if division_shape is not None:
-					px_division.prepend_coords(self._transform(
-						division_shape.exterior.coords))
+					px_coords.add(px_division, division_shape.exterior.coords)
 					division_shapes.append(division_shape)
 				else:
 					px_column.remove(px_division)
 
 			column_shape = polygon_union(division_shapes)
 			if column_shape is not None:
-				px_column.prepend_coords(self._transform(
-					column_shape.exterior.coords))
+				px_coords.add(px_column, column_shape.exterior.coords)
 				column_shapes.append(column_shape)
 			else:
 				px_table_region.remove(px_column)
 
 		table_shape = polygon_union(column_shapes)
 		if table_shape is not None:
-			px_table_region.prepend_coords(self._transform(
-				table_shape.exterior.coords))
+			px_coords.add(px_table_region, table_shape.exterior.coords)
 		else:
 			logging.warning("table %s was empty on page %s." % (
 				str(self._block_path), self._document.page_path))
@@ -304,38 +376,32 @@ class TableRegion:
 
 	def append_cell_text(self, grid, line_path, text):
 		division, row, column = tuple(map(int, grid))
-		self._divisions.add(division)
-		self._rows[division].add(row)
-		self._columns.add(column)
-		self._texts[(division, row, column)].append((line_path, text))
+		self._divisions |= 1 << division
+		self._rows[division] |= 1 << row
+		self._columns |= 1 << column
+		self._texts[cell_key(division, row, column)].append((line_path, text))
 
 	def to_text(self):
-		columns = sorted(list(self._columns))
+		columns = bit_indices(self._columns)
 		table_data = []
 		n_rows = []
 
-		divisions = sorted(list(self._divisions))
-		for division in divisions:
-			rows = sorted(list(self._rows[division]))
+		for division in bit_indices(self._divisions):
+			rows = bit_indices(self._rows[division])
 			n_rows.append(len(rows))
 			for row in rows:
 				row_data = []
 				for column in columns:
 					texts = [s.strip() for _, s in self._texts.get(
-						(division, row, column), [])]
+						cell_key(division, row, column), [])]
 					row_data.append("\n".join(texts))
 				table_data.append(row_data)
 
 		if len(columns) == 1:
 			return "\n".join(["".join(x) for x in table_data])
 		else:
-			if len(n_rows) >= 2 and n_rows[0] == 1:
-				headers = "firstrow"
-			else:
-				headers = ()
-
-			return tabulate(
-				table_data, tablefmt="psql", headers=headers)
+			return format_psql_table(
+				table_data, has_header=len(n_rows) >= 2 and n_rows[0] == 1)
 
 
 class GraphicRegion:
@@ -345,13 +411,11 @@ class GraphicRegion:
 		self._block = blocks[0][1]
 		self._lines = lines
 		self._block_path = block_path
-		self._transform = document.rewarp
 
-	def export_page_xml(self, px_document, only_regions):
+	def export_page_xml(self, px_document, px_coords, only_regions):
 		px_region = px_document.append_region(
 			"GraphicRegion", id_="-".join(self._block_path))
-		px_region.append_coords(self._transform(
-			self._block.image_space_polygon.exterior.coords))
+		px_coords.add(px_region, self._block.image_space_polygon.exterior.coords)
 
 
 class Document:
@@ -359,6 +423,13 @@ class Document:
 		self._page_path = page_path
 		self._input = input
 		self._grid = self.page.dewarper.grid
+		self._rewarped = dict()
+
+		# Page XML is very picky about not specifying any
+		# negative coordinates. we need to clip.
+		width, height = self.page.size(False)
+		self._page_box = shapely.geometry.box(0, 0, width, height)
+		self._prepared_page_box = shapely.prepared.prep(self._page_box)
 		self._rewriter = LineRewriter(input.tables)
 		self._block_filter = block_filter
 		self._text_filter = text_filter
@@ -366,34 +437,41 @@ class Document:
 		combinator = TableRegionCombinator(input.regions.by_path.keys())
 		self._mapping = combinator.mapping
 
-		region_lines = collections.defaultdict(list)
-		for line_path, line in input.lines.by_path.items():
-			region_lines[line_path[:3]].append((line_path, line))
-		self._region_lines = region_lines
+		# lines usually come grouped by block already, which makes
+		# this (stable) sort cheap.
+		def line_block_path(item):
+			return item[0][:3]
+
+		self._region_lines = dict(
+			(block_path, list(items))
+			for block_path, items in itertools.groupby(
+				sorted(input.lines.by_path.items(), key=line_block_path),
+				key=line_block_path))
 
 		self._regions = dict()
+		self._skipped_regions = set()
 
 		# add lines and line texts in correct order.
 		for line_path, ocr_text in input.sorted_ocr:
 			ocr_text = self._text_filter(ocr_text)
 
 			block_path = fix_bogus_tabular_path(line_path[:3])
-			table_path = block_path[2].split(".")
+			block_id, is_table, grid = block_path[2].partition(".")
 
-			if len(table_path) > 1:
-				assert block_path[:2] == ("regions", "TABULAR")
-				base_block_path = block_path[:2] + (table_path[0],)
+			if is_table:
+				assert block_path[0] == "regions" and block_path[1] == "TABULAR"
+				base_block_path = block_path[:2] + (block_id,)
 
 				self._add(TableRegion, base_block_path).append_cell_text(
-					table_path[1:], line_path, ocr_text)
+					grid.split("."), line_path, ocr_text)
 			else:
-				assert block_path[:2] == ("regions", "TEXT")
+				assert block_path[0] == "regions" and block_path[1] == "TEXT"
 				self._add(TextRegion, block_path).add_text(
 					line_path, ocr_text)
 
 		# add graphics regions.
 		for block_path, block in input.regions.by_path.items():
-			if block_path[:2] == ("regions", "ILLUSTRATION"):
+			if block_path[1] == "ILLUSTRATION" and block_path[0] == "regions":
 				self._add(GraphicRegion, block_path)
 
 	@property
@@ -411,25 +489,51 @@ class Document:
 		return self._rewriter(lines)
 
 	def rewarp(self, coords):
-		warped_coords = self._grid.inverse(coords)
-		# Page XML is very picky about not specifying any
-		# negative coordinates. we need to clip.
-		width, height = self.page.size(False)
-		box = shapely.geometry.box(0, 0, width, height)
+		return self.rewarp_many([coords])[0]
+
+	def rewarp_many(self, rings):
+		# the same rings (e.g. unions of a single table cell) come
+		# up more than once per page, so we cache by coordinates.
+		rings = [np.asarray(coords, dtype=np.float64) for coords in rings]
+		keys = [coords.tobytes() for coords in rings]
+
+		missing = dict()
+		for key, coords in zip(keys, rings):
+			if key not in self._rewarped:
+				missing[key] = coords
+
+		if missing:
+			# inverting the dewarping grid is costly per call, so
+			# we run all rings through it in one go.
+			missing_rings = list(missing.values())
+			offsets = np.cumsum([len(coords) for coords in missing_rings])[:-1]
+			warped_rings = np.split(
+				self._grid.inverse(np.concatenate(missing_rings)), offsets)
+
+			for key, coords, warped_coords in zip(
+				missing.keys(), missing_rings, warped_rings):
+				self._rewarped[key] = self._clip(coords, warped_coords)
+
+		return [self._rewarped[key] for key in keys]
+
+	def _clip(self, coords, warped_coords):
 		poly = shapely.geometry.Polygon(warped_coords)
 		if not poly.is_valid:
 			poly = poly.convex_hull
-		page_poly = poly.intersection(box)
+		if self._prepared_page_box.contains(poly):
+			# most rings are inside the page, no need to clip.
+			page_poly = poly
+		else:
+			page_poly = poly.intersection(self._page_box)
 		if page_poly.is_empty:
 			raise RuntimeError(
 				"failed to rewarp coords %s as %s outside page" % (
-					str(list(coords)),
+					str(coords.tolist()),
 					poly))
-			return None
 		elif page_poly.geom_type == "Polygon":
-			return page_poly.exterior.coords
+			return np.asarray(page_poly.exterior.coords)
 		else:
-			return page_poly.convex_hull.exterior.coords
+			return np.asarray(page_poly.convex_hull.exterior.coords)
 
 	def blocks_and_lines(self, block_path):
 		blocks = []
@@ -437,7 +541,7 @@ class Document:
 		for path in self._mapping[block_path]:
 			fixed_path = fix_bogus_tabular_path(path)
 			blocks.append((fixed_path, self._input.regions.by_path[path]))
-			lines.extend(self._region_lines[path])
+			lines.extend(self._region_lines.get(path, []))
 		return blocks, dict(lines)
 
 	def _add(self, class_, block_path):
@@ -453,12 +557,16 @@ class Document:
 		if region is not None:
 			return region
 
+		if block_path in self._skipped_regions:
+			return None
+
 		confidences = [
 			l.confidence
-			for _, l in self._region_lines[block_path]]
+			for _, l in self._region_lines.get(block_path, [])]
 		min_confidence = self._input.lines.min_confidence
 
 		if all(c < min_confidence for c in confidences):
+			self._skipped_regions.add(block_path)
 			return None
 		else:
 			raise RuntimeError(
@@ -526,11 +634,7 @@ class RegionReadingOrder:
 		l0 = lines[self._regionless_text_lines[-1]]
 		l1 = lines[line_path]
 
-		# FIXME
-		if l0.image_space_polygon.distance(l1.image_space_polygon) < 5:
-			return True
-
-		return True
+		return l0.image_space_polygon.distance(l1.image_space_polygon) < 5
 
 	def _add_regionless_line(self, line_path):
 		if not self._is_adjacent(line_path):
@@ -545,7 +649,7 @@ class RegionReadingOrder:
 			if region is not None:
 				self._ordered_regions.append((path, region))
 		elif len(path) > 3:  # line path?
-			assert path[:2] == ("regions", "TEXT")
+			assert path[0] == "regions" and path[1] == "TEXT"
 			self._add_regionless_line(path)
 		else:
 			raise ValueError("illegal region/line path %s" % str(path))
@@ -566,7 +670,7 @@ class PlainTextComposition:
 	def __init__(self, line_separator, block_separator):
 		self._line_separator = line_separator
 		self._block_separator = block_separator
-		self._texts = []
+		self._blocks = []
 		self._path = None
 
 	def append_text(self, path, text):
@@ -574,15 +678,19 @@ class PlainTextComposition:
 		if not text:
 			return
 		assert isinstance(path, tuple)
-		if self._path is not None:
-			if path[:3] != self._path[:3]:
-				self._texts.append(self._block_separator)
+		if self._path is None or path[:3] != self._path[:3]:
+			self._blocks.append([])
 		self._path = path
-		self._texts.append(text + "\n")
+		self._blocks[-1].append(text)
 
 	@property
 	def text(self):
-		return "".join(self._texts)
+		# every line, including the last one of each
+		# block, is terminated by a line separator.
+		line_separator = self._line_separator
+		return self._block_separator.join(
+			line_separator.join(lines) + line_separator
+			for lines in self._blocks)
 
 
 class LetterFilter:
@@ -604,6 +712,7 @@ class ComposeProcessor(Processor):
 		self._options = options
 		self._page_xml = options["page_xml"]
 		self._only_page_xml_regions = options["only_page_xml_regions"]
+		self._validate_page_xml = options["validate_page_xml"]
 
 		if options["regions"]:
 			self._block_filter = RegionsFilter(options["regions"])
@@ -637,7 +746,7 @@ class ComposeProcessor(Processor):
 			("output", Output(Artifact.COMPOSE)),
 		]
 
-	def export_page_xml(self, page_path, document):
+	def export_page_xml(self, page_path, document, f):
 		page = document.page
 
 		px_document = pagexml.Document(
@@ -659,14 +768,16 @@ class ComposeProcessor(Processor):
 			px_ro_group.append_region_ref_indexed(
 				index=i, region_ref="-".join(path))
 
+		px_coords = RewarpedCoords(document)
 		for region in ro.regions:
 			region.export_page_xml(
 				px_document,
+				px_coords,
 				self._only_page_xml_regions)
+		px_coords.flush()
 
-		with io.BytesIO() as f:
-			px_document.write(f, overwrite=True, validate=True)
-			return f.getvalue()
+		px_document.write(
+			f, overwrite=True, validate=self._validate_page_xml)
 
 	def export_plain_text(self, document):
 		composition = PlainTextComposition(
@@ -699,7 +810,8 @@ class ComposeProcessor(Processor):
 		with output.compose() as zf:
 			zf.writestr("page.txt", self.export_plain_text(document))
 			if self._page_xml:
-				zf.writestr("page.xml", self.export_page_xml(page_path, document))
+				with zf.open("page.xml", "w") as f:
+					self.export_page_xml(page_path, document, f)
 
 
 @click.command()
@@ -725,6 +837,11 @@ class ComposeProcessor(Processor):
 	'--only-page-xml-regions',
 	is_flag=True,
 	default=False)
+@click.option(
+	'--validate-page-xml',
+	is_flag=True,
+	default=False,
+	help="Validate Page XML output against the schema.")
 @click.option(
 	'--ignore-letters',
 	type=str,
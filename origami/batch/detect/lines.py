@@ -3,10 +3,13 @@
 import click
 import json
 import numpy as np
-import cv2
 import logging
+import zipfile
+import time
+import collections
 
 from pathlib import Path
+from numba import njit
 
 from origami.batch.core.processor import Processor
 from origami.batch.core.io import Artifact, Stage, Input, Output
@@ -15,41 +18,89 @@ from origami.batch.core.utils import RegionsFilter
 from origami.batch.core.lines import reliable_contours
 
 
-def scale_grid(s0, s1, grid):
-	h0, w0 = s0
-	h1, w1 = s1
-	grid[:, :, 0] *= w1 / w0
-	grid[:, :, 1] *= h1 / h0
+# explicit signature, so that the kernel gets compiled (or loaded
+# from cache) on import, not on the first line of the first page.
+@njit("float64[:, :](uint8[:, ::1], float32[:, ::1], int64[::1], float32, float32, int64)", cache=True)
+def _remap_nn_tally(labels, points, offsets, sx, sy, n_classes):
+	# equivalent to scaling the points of each line (given as a range
+	# in offsets) by (sx, sy), running cv2.remap with INTER_NEAREST and
+	# BORDER_CONSTANT on labels, and counting the fraction of samples
+	# per class, but without any intermediate arrays. labels >=
+	# n_classes only count towards the total.
+	n_lines = len(offsets) - 1
+	counts = np.zeros((n_lines, n_classes), dtype=np.float64)
+	lh, lw = labels.shape
+	for i in range(n_lines):
+		for j in range(offsets[i], offsets[i + 1]):
+			x = round(points[j, 0] * sx)
+			y = round(points[j, 1] * sy)
+			if 0 <= x < lw and 0 <= y < lh:
+				label = labels[y, x]
+			else:
+				label = 0
+			if label < n_classes:
+				counts[i, label] += 1
+		n = offsets[i + 1] - offsets[i]
+		if n > 0:
+			counts[i, :] /= n
+	return counts
+
+
+def stored_zip_info(name, date_time):
+	# line infos are tiny, deflating them costs more than it saves.
+	info = zipfile.ZipInfo(name, date_time=date_time)
+	info.compress_type = zipfile.ZIP_STORED
+	info.external_attr = 0o600 << 16
+	return info
 
 
 class ConfidenceSampler:
 	def __init__(self, blocks, segmentation):
 		self._predictions = dict()
+		self._labels = dict()
+		self._n_classes = dict()
 		for p in segmentation.predictions:
 			self._predictions[p.name] = p
+			# the sampling kernel is compiled for C-contiguous uint8 labels.
+			self._labels[p.name] = np.ascontiguousarray(p.labels, dtype=np.uint8)
+			self._n_classes[p.name] = 1 + max(k.value for k in p.classes)
 
 		self._page = list(blocks.values())[0].page
 		self._page_shape = tuple(reversed(self._page.warped.size))
 
 	def __call__(self, path, line, res=0.5):
-		prediction_name, predictor_class = path[:2]
-
-		predictor = self._predictions[prediction_name]
-
-		grid = line.warped_grid(xres=res, yres=res)
-
-		scale_grid(self._page_shape, predictor.labels.shape, grid)
-		labels = cv2.remap(predictor.labels, grid, None, cv2.INTER_NEAREST)
-
-		counts = np.bincount(labels.flatten(), minlength=len(predictor.classes))
-
-		evidence = dict()
-
-		sum_all = np.sum(counts)
-		if sum_all > 0:
-			for k in predictor.classes:
-				key = "%s/%s" % (prediction_name, k.name)
-				evidence[key] = counts[k.value] / sum_all
+		return self.sample_many([(path, line)], res=res)[0]
+
+	def sample_many(self, items, res=0.5):
+		# sample all lines of one predictor in a single kernel call.
+		by_prediction = collections.defaultdict(list)
+		for i, (path, _) in enumerate(items):
+			by_prediction[path[0]].append(i)
+
+		h0, w0 = self._page_shape
+		evidence = [dict() for _ in items]
+
+		for prediction_name, indices in by_prediction.items():
+			predictor = self._predictions[prediction_name]
+			labels = self._labels[prediction_name]
+			h1, w1 = labels.shape
+
+			grids = [
+				items[i][1].warped_grid(xres=res, yres=res).reshape(-1, 2)
+				for i in indices]
+			offsets = np.cumsum(
+				[0] + [len(grid) for grid in grids], dtype=np.int64)
+
+			fractions = _remap_nn_tally(
+				labels, np.concatenate(grids), offsets,
+				np.float32(w1 / w0), np.float32(h1 / h0),
+				self._n_classes[prediction_name])
+
+			for i, grid, line_fractions in zip(indices, grids, fractions):
+				if len(grid) > 0:
+					for k in predictor.classes:
+						key = "%s/%s" % (prediction_name, k.name)
+						evidence[i][key] = line_fractions[k.value]
 
 		return evidence
 
@@ -96,9 +147,13 @@ class LineDetectionProcessor(Processor):
 
 		detected_lines_by_block = detector(text_blocks)
 
-		for block_path, lines in detected_lines_by_block.items():
-			for line in lines:
-				line.update_confidence(sampler(block_path, line))
+		sampled_lines = [
+			(block_path, line)
+			for block_path, lines in detected_lines_by_block.items()
+			for line in lines]
+		for (_, line), evidence in zip(
+			sampled_lines, sampler.sample_many(sampled_lines)):
+			line.update_confidence(evidence)
 
 		table_columns = aggregate.tables["columns"]
 		c_tables = set([tuple(x.split("/")) for x in table_columns.keys()])
@@ -133,8 +188,11 @@ class LineDetectionProcessor(Processor):
 			info = dict(version=1, min_confidence=self._min_confidence)
 			zf.writestr("meta.json", json.dumps(info))
 
+			date_time = time.localtime(time.time())[:6]
 			for line_path, line in detected_lines.items():
-				zf.writestr("%s.json" % "/".join(map(str, line_path)), json.dumps(line.info))
+				zf.writestr(stored_zip_info(
+					"%s.json" % "/".join(map(str, line_path)), date_time),
+					json.dumps(line.info))
 
 		with output.contours(copy_meta_from=aggregate) as zf:
 			for k, contour in reliable.items():
@@ -127,6 +127,7 @@ def dinglehopper(data_path, **kwargs):
 	compose_options["regions"] = "regions/TEXT"
 	compose_options["page_xml"] = True
 	compose_options["only_page_xml_regions"] = True
+	compose_options["validate_page_xml"] = True
 
 	processor = ComposeProcessor(compose_options)
 	processor.traverse(data_path)
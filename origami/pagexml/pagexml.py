@@ -3,6 +3,7 @@
 import os
 import datetime
 import logging
+import numpy as np
 
 from lxml import etree
 from pathlib import Path
@@ -45,17 +46,13 @@ class Document:
 		self._page.remove(element._node)
 
 	def append_region(self, class_, **kwargs):
-		region = Region(class_=class_, **kwargs)
-		self.append(region)
-		return region
+		return Region(class_=class_, parent=self._page, **kwargs)
 
 	def append_text_region(self, **kwargs):
 		return self.append_region(class_="TextRegion", **kwargs)
 
 	def append_reading_order(self):
-		ro = ReadingOrder()
-		self.append(ro)
-		return ro
+		return ReadingOrder(parent=self._page)
 
 	def write(self, path, validate=True, overwrite=False):
 		if not overwrite and Path(path).exists():
@@ -90,71 +87,71 @@ class Document:
 			raise
 
 
-def format_coord(p):
-	return '%d,%d' % tuple(map(round, p))
+def make_node(name, parent=None):
+	# creating children through SubElement avoids setting up a
+	# separate lxml document for each new node.
+	tag = "{%s}%s" % (namespace, name)
+	if parent is None:
+		return etree.Element(tag, nsmap=nsmap)
+	else:
+		return etree.SubElement(parent, tag)
 
 
-def make_coords_node(coords):
-	coords_str = ' '.join(format_coord(p) for p in coords)
-	node = etree.Element(etree.QName(namespace, "Coords"), nsmap=nsmap)
-	node.set("points", coords_str)
+def format_coords(coords):
+	# round all points in one go, coords may be any (n, 2) sequence or array.
+	points = np.rint(np.asarray(coords, dtype=np.float64)).astype(np.int64)
+	return ' '.join('%d,%d' % (x, y) for x, y in points.tolist())
+
+
+def make_coords_node(coords, parent=None):
+	node = make_node("Coords", parent)
+	node.set("points", format_coords(coords))
 	return node
 
 
-def make_text_node(text):
-	unicode_node = etree.Element(
-		etree.QName(namespace, "Unicode"), nsmap=nsmap)
+def make_text_node(text, parent=None):
+	text_equiv_node = make_node("TextEquiv", parent)
+	unicode_node = make_node("Unicode", text_equiv_node)
 	unicode_node.text = text
-
-	text_equiv_node = etree.Element(
-		etree.QName(namespace, "TextEquiv"), nsmap=nsmap)
-	text_equiv_node.append(unicode_node)
 	return text_equiv_node
 
 
 class ReadingOrder:
-	def __init__(self):
-		self._node = etree.Element(
-			etree.QName(namespace, "ReadingOrder"), nsmap=nsmap)
+	def __init__(self, parent=None):
+		self._node = make_node("ReadingOrder", parent)
 
 	def append_ordered_group(self, **kwargs):
-		g = OrderedGroup(**kwargs)
-		self._node.append(g._node)
-		return g
+		return OrderedGroup(parent=self._node, **kwargs)
 
 
 class OrderedGroup:
-	def __init__(self, id_, caption=""):
-		self._node = etree.Element(
-			etree.QName(namespace, "OrderedGroup"), nsmap=nsmap)
+	def __init__(self, id_, caption="", parent=None):
+		self._node = make_node("OrderedGroup", parent)
 		self._node.set("id", id_)
 		if caption:
 			self._node.set("caption", caption)
 
 	def append_region_ref_indexed(self, index, region_ref):
-		node = etree.Element(
-			etree.QName(namespace, "RegionRefIndexed"), nsmap=nsmap)
+		node = make_node("RegionRefIndexed", self._node)
 		node.set("index", str(index))
 		node.set("regionRef", region_ref)
-		self._node.append(node)
 
 
 class Region:
-	def __init__(self, id_, class_="TextRegion", type_=None):
-		self._node = etree.Element(
-			etree.QName(namespace, class_), nsmap=nsmap)
+	def __init__(self, id_, class_="TextRegion", type_=None, parent=None):
+		self._node = make_node(class_, parent)
 		self._node.set('id', id_)
 		if type_ is not None:
 			self._node.set('type', type_)
 
 	def append_coords(self, coords):
-		self._node.append(make_coords_node(coords))
+		make_coords_node(coords, self._node)
 
 	def prepend_coords(self, coords):
 		self._node.insert(0, make_coords_node(coords))
 
 	def append_text_equiv(self, text):
-		self._node.append(make_text_node(text))
+		make_text_node(text, self._node)
 
 	def append(self, element):
 		self._node.append(element._node)
@@ -163,14 +160,10 @@ class Region:
 		self._node.remove(element._node)
 
 	def append_text_line(self, **kwargs):
-		line = TextLine(**kwargs)
-		self.append(line)
-		return line
+		return TextLine(parent=self._node, **kwargs)
 
 	def append_text_region(self, **kwargs):
-		region = Region(class_="TextRegion", **kwargs)
-		self.append(region)
-		return region
+		return Region(class_="TextRegion", parent=self._node, **kwargs)
 
 
 class TextRegion(Region):
@@ -179,13 +172,15 @@ class TextRegion(Region):
 
 
 class TextLine:
-	def __init__(self, id_):
-		self._node = etree.Element(
-			etree.QName(namespace, "TextLine"), nsmap=nsmap)
+	def __init__(self, id_, parent=None):
+		self._node = make_node("TextLine", parent)
 		self._node.set('id', id_)
 
 	def append_coords(self, coords):
-		self._node.append(make_coords_node(coords))
+		make_coords_node(coords, self._node)
+
+	def prepend_coords(self, coords):
+		self._node.insert(0, make_coords_node(coords))
 
 	def append_text_equiv(self, text):
-		self._node.append(make_text_node(text))
+		make_text_node(text, self._node)